@@ -55,10 +55,11 @@ def average(metrics, count=1.):
     return (tensor[:-1] / tensor[-1]).cpu().numpy().tolist()
 
 
-def wrap(model):
+def wrap(model, **kwargs):
     """wrap.
 
     Wrap a model with DDP if distributed training is enabled.
+    Extra keyword arguments are passed to `DistributedDataParallel`.
     """
     if world_size == 1:
         return model
@@ -66,7 +67,8 @@ def wrap(model):
         return DistributedDataParallel(
             model,
             device_ids=[torch.cuda.current_device()],
-            output_device=torch.cuda.current_device())
+            output_device=torch.cuda.current_device(),
+            **kwargs)
 
 
 def barrier():
@@ -98,4 +100,4 @@ def loader(dataset, *args, shuffle=False, klass=DataLoader, **kwargs):
     else:
         # We make a manual shard, as DistributedSampler otherwise replicate some examples
         dataset = Subset(dataset, list(range(rank, len(dataset), world_size)))
-        return klass(dataset, *args, shuffle=shuffle)
+        return klass(dataset, *args, shuffle=shuffle, **kwargs)
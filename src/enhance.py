@@ -9,7 +9,6 @@ from src.utils import LogProgress, convert_spectrogram_to_heatmap
 logger = logging.getLogger(__name__)
 
 def get_estimate(model, lr_sig):
-    torch.set_num_threads(1)
     with torch.no_grad():
         out = model(lr_sig)
     return out
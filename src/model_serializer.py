@@ -29,35 +29,70 @@ def _serialize_models(models):
     return serialized_models
 
 
+def _copy_optimizer_state(state):
+    # optimizer states hold references to tensors that are updated in place by the following steps
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: _copy_optimizer_state(v) for k, v in state.items()}
+    if isinstance(state, list):
+        return [_copy_optimizer_state(v) for v in state]
+    return state
+
+
 def _serialize_optimizers(optimizers):
     serialized_optimizers = {}
     for name, optimizer in optimizers.items():
-        serialized_optimizers[name] = optimizer.state_dict()
+        serialized_optimizers[name] = _copy_optimizer_state(optimizer.state_dict())
     return serialized_optimizers
 
 
-def serialize(models, optimizers, history, best_states, args):
-    checkpoint_file = Path(args.checkpoint_file)
-    best_file = Path(args.best_file)
+def serialize(models, optimizers, history, best_states, args, executor=None, save_best=True):
+    """serialize.
 
+    Save a checkpoint of the models, optimizers and history, along with the best models
+    if `save_best` is set (i.e. the best states changed since they were last saved).
+    The states are copied to the CPU right away. If an `executor` is given, writing to
+    disk is submitted to it and the corresponding future is returned, so that training
+    can continue in the meantime.
+    """
     package = {}
     package[SERIALIZE_KEY_MODELS] = _serialize_models(models)
     package[SERIALIZE_KEY_OPTIMIZERS] = _serialize_optimizers(optimizers)
-    package[SERIALIZE_KEY_HISTORY] = history
+    package[SERIALIZE_KEY_HISTORY] = list(history)
     package[SERIALIZE_KEY_BEST_STATES] = best_states
     package[SERIALIZE_KEY_ARGS] = args
-    tmp_path = str(checkpoint_file) + ".tmp"
-    torch.save(package, tmp_path)
+    if executor is None:
+        _save_package(package, args, save_best)
+        return None
+    return executor.submit(_save_package, package, args, save_best)
+
+
+def _save_package(package, args, save_best):
+    checkpoint_file = Path(args.checkpoint_file)
+    _save_latest(package, checkpoint_file)
+    if save_best:
+        _save_best(package, Path(args.best_file))
+    logger.debug("Checkpoint saved to %s", checkpoint_file.resolve())
+
+
+def _save(obj, path):
+    tmp_path = str(path) + ".tmp"
+    torch.save(obj, tmp_path)
     # renaming is sort of atomic on UNIX (not really true on NFS)
     # but still less chances of leaving a half written checkpoint behind.
-    os.rename(tmp_path, checkpoint_file)
+    os.rename(tmp_path, path)
+
+
+def _save_latest(package, checkpoint_file):
+    _save(package, checkpoint_file)
+
 
+def _save_best(package, best_file):
     # Saving only the latest best model.
-    models = package[SERIALIZE_KEY_MODELS]
     for model_name, best_state in package[SERIALIZE_KEY_BEST_STATES].items():
-        models[model_name][SERIALIZE_KEY_STATE] = best_state
+        # shallow copy, the package itself is left untouched
+        model_package = dict(package[SERIALIZE_KEY_MODELS][model_name])
+        model_package[SERIALIZE_KEY_STATE] = best_state
         model_filename = model_name + '_' + best_file.name
-        tmp_path = os.path.join(best_file.parent, model_filename) + ".tmp"
-        torch.save(models[model_name], tmp_path)
-        model_path = Path(best_file.parent / model_filename)
-        os.rename(tmp_path, model_path)
\ No newline at end of file
+        _save(model_package, best_file.parent / model_filename)
@@ -429,7 +429,9 @@ class Aero(nn.Module):
 
     def _move_complex_to_channels_dim(self, z):
         B, C, Fr, T = z.shape
-        m = torch.view_as_real(z).permute(0, 1, 4, 2, 3)
+        # stacking real and imaginary parts writes the [B, C, 2, Fr, T] layout directly,
+        # the reshape below is then a view
+        m = torch.stack((z.real, z.imag), dim=2)
         m = m.reshape(B, C * 2, Fr, T)
         return m
 
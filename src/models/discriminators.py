@@ -86,6 +86,28 @@ def get_padding(kernel_size, dilation=1):
     return int((kernel_size * dilation - dilation) / 2)
 
 
+def _run_real_and_generated(discriminators, y, y_hat, pool=None):
+    # y can be None to only score y_hat, real outputs are then empty. Otherwise y and y_hat go
+    # through every discriminator as a single batch, split again on the outputs
+    y_d_rs = []
+    y_d_gs = []
+    fmap_rs = []
+    fmap_gs = []
+    n_real = 0 if y is None else y.shape[0]
+    x = y_hat if y is None else torch.cat([y, y_hat])
+    for i, d in enumerate(discriminators):
+        if pool is not None and i != 0:
+            x = pool(i, x)
+        y_d, fmap = d(x)
+        if y is not None:
+            y_d_rs.append(y_d[:n_real])
+            fmap_rs.append([f[:n_real] for f in fmap])
+        y_d_gs.append(y_d[n_real:])
+        fmap_gs.append([f[n_real:] for f in fmap])
+
+    return y_d_rs, y_d_gs, fmap_rs, fmap_gs
+
+
 class DiscriminatorP(torch.nn.Module):
     @capture_init
     def __init__(self, period, kernel_size=5, stride=3, use_spectral_norm=False, hidden=32):
@@ -132,19 +154,7 @@ class MultiPeriodDiscriminator(torch.nn.Module):
         ])
 
     def forward(self, y, y_hat):
-        y_d_rs = []
-        y_d_gs = []
-        fmap_rs = []
-        fmap_gs = []
-        for i, d in enumerate(self.discriminators):
-            y_d_r, fmap_r = d(y)
-            y_d_g, fmap_g = d(y_hat)
-            y_d_rs.append(y_d_r)
-            fmap_rs.append(fmap_r)
-            y_d_gs.append(y_d_g)
-            fmap_gs.append(fmap_g)
-
-        return y_d_rs, y_d_gs, fmap_rs, fmap_gs
+        return _run_real_and_generated(self.discriminators, y, y_hat)
 
 
 class DiscriminatorS(torch.nn.Module):
@@ -190,55 +200,25 @@ class MultiScaleDiscriminator(torch.nn.Module):
         ])
 
     def forward(self, y, y_hat):
-        y_d_rs = []
-        y_d_gs = []
-        fmap_rs = []
-        fmap_gs = []
-        for i, d in enumerate(self.discriminators):
-            if i != 0:
-                y = self.meanpools[i - 1](y)
-                y_hat = self.meanpools[i - 1](y_hat)
-            y_d_r, fmap_r = d(y)
-            y_d_g, fmap_g = d(y_hat)
-            y_d_rs.append(y_d_r)
-            fmap_rs.append(fmap_r)
-            y_d_gs.append(y_d_g)
-            fmap_gs.append(fmap_g)
-
-        return y_d_rs, y_d_gs, fmap_rs, fmap_gs
+        # every discriminator after the first one sees the signals pooled once more
+        return _run_real_and_generated(self.discriminators, y, y_hat,
+                                       pool=lambda i, x: self.meanpools[i - 1](x))
 
 
 def feature_loss(fmap_r, fmap_g):
-    loss = 0
-    total_n_layers = 0
-    for dr, dg in zip(fmap_r, fmap_g):
-        for rl, gl in zip(dr, dg):
-            total_n_layers += 1
-            loss += torch.mean(torch.abs(rl - gl))
-
-    return loss / total_n_layers
+    losses = [torch.mean(torch.abs(rl - gl)) for dr, dg in zip(fmap_r, fmap_g) for rl, gl in zip(dr, dg)]
+    return torch.stack(losses).mean()
 
 
 def discriminator_loss(disc_real_outputs, disc_generated_outputs):
-    loss = 0
-    # r_losses = []
-    # g_losses = []
+    losses = []
     for dr, dg in zip(disc_real_outputs, disc_generated_outputs):
         r_loss = torch.mean((1 - dr) ** 2)
         g_loss = torch.mean(dg ** 2)
-        loss += (r_loss + g_loss)
-        # r_losses.append(r_loss.item())
-        # g_losses.append(g_loss.item())
+        losses.append(r_loss + g_loss)
 
-    return loss  # , r_losses, g_losses
+    return torch.stack(losses).sum()
 
 
 def generator_loss(disc_outputs):
-    loss = 0
-    # gen_losses = []
-    for dg in disc_outputs:
-        l = torch.mean((1 - dg) ** 2)
-        # gen_losses.append(l)
-        loss += l
-
-    return loss  # , gen_losses
\ No newline at end of file
+    return torch.stack([torch.mean((1 - dg) ** 2) for dg in disc_outputs]).sum()
\ No newline at end of file
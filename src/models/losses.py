@@ -0,0 +1,51 @@
+"""Time domain and adversarial loss modules."""
+
+import torch
+
+
+class FusedGenLoss(torch.nn.Module):
+    """Time domain L1/L2 reconstruction losses of the generator.
+
+    Both losses share a single difference of the signals, so that when compiled
+    the subtraction and the reductions are fused together.
+    """
+
+    def __init__(self, l1=True, l2=True):
+        """Initialize the losses module.
+        Args:
+            l1 (bool): compute the L1 loss.
+            l2 (bool): compute the L2 loss.
+        """
+        super(FusedGenLoss, self).__init__()
+        self.l1 = l1
+        self.l2 = l2
+
+    def forward(self, x, y):
+        """Calculate forward propagation.
+        Args:
+            x (Tensor): Predicted signal (B, C, T).
+            y (Tensor): Groundtruth signal (B, C, T).
+        Returns:
+            dict: L1 and/or L2 loss values, under the 'l1' and 'l2' keys.
+        """
+        # reductions are done in full precision, as F.l1_loss/F.mse_loss do under autocast
+        diff = x.float() - y.float()
+        losses = {}
+        if self.l1:
+            losses['l1'] = diff.abs().mean()
+        if self.l2:
+            losses['l2'] = diff.square().mean()
+        return losses
+
+
+def hinge_pos(x):
+    """Hinge loss of discriminator outputs that should be above 1, i.e. mean(relu(1 - x)).
+
+    clamp_min saves the separate relu kernel, compiled the whole expression becomes a single reduction.
+    """
+    return torch.clamp_min(1.0 - x, 0.0).mean()
+
+
+def hinge_neg(x):
+    """Hinge loss of discriminator outputs that should be below -1, i.e. mean(relu(1 + x))."""
+    return torch.clamp_min(1.0 + x, 0.0).mean()
@@ -12,7 +12,7 @@ def spectro(x, n_fft=512, hop_length=None, pad=0, win_length=None):
     z = th.stft(x,
                 n_fft * (1 + pad),
                 hop_length or n_fft // 4,
-                window=th.hann_window(win_length).to(x),
+                window=th.hann_window(win_length, dtype=x.dtype, device=x.device),
                 win_length=win_length or n_fft,
                 normalized=True,
                 center=True,
@@ -30,7 +30,7 @@ def ispectro(z, hop_length=None, length=None, pad=0, win_length=None):
     x = th.istft(z,
                  n_fft,
                  hop_length or n_fft // 2,
-                 window=th.hann_window(win_length).to(z.real),
+                 window=th.hann_window(win_length, dtype=z.real.dtype, device=z.device),
                  win_length=win_length,
                  normalized=True,
                  length=length,
@@ -11,7 +11,7 @@ import torch.nn.functional as F
 def stft(x, fft_size, hop_size, win_length, window):
     """Perform STFT and convert to magnitude spectrogram.
     Args:
-        x (Tensor): Input signal tensor (B, T).
+        x (Tensor): Input signal tensor (B, T) or (B, C, T), channels are folded into the batch.
         fft_size (int): FFT size.
         hop_size (int): Hop size.
         win_length (int): Window length.
@@ -19,12 +19,13 @@ def stft(x, fft_size, hop_size, win_length, window):
     Returns:
         Tensor: Magnitude spectrogram (B, #frames, fft_size // 2 + 1).
     """
-    x_stft = torch.stft(x, fft_size, hop_size, win_length, window)
-    real = x_stft[..., 0]
-    imag = x_stft[..., 1]
+    # a view for contiguous signals, so that callers need not squeeze the channel dimension themselves
+    x = x.reshape(-1, x.shape[-1])
+    x_stft = torch.stft(x, fft_size, hop_size, win_length, window, return_complex=True)
 
     # NOTE(kan-bayashi): clamp is needed to avoid nan or inf
-    return torch.sqrt(torch.clamp(real ** 2 + imag ** 2, min=1e-7)).transpose(2, 1)
+    # the magnitude is taken directly on the complex tensor, same as sqrt(clamp(real ** 2 + imag ** 2, min=1e-7))
+    return torch.clamp(x_stft.abs(), min=1e-7 ** 0.5).transpose(2, 1)
 
 
 class SpectralConvergengeLoss(torch.nn.Module):
@@ -79,8 +80,8 @@ class STFTLoss(torch.nn.Module):
     def forward(self, x, y):
         """Calculate forward propagation.
         Args:
-            x (Tensor): Predicted signal (B, T).
-            y (Tensor): Groundtruth signal (B, T).
+            x (Tensor): Predicted signal (B, T) or (B, C, T).
+            y (Tensor): Groundtruth signal (B, T) or (B, C, T).
         Returns:
             Tensor: Spectral convergence loss value.
             Tensor: Log STFT magnitude loss value.
@@ -120,19 +121,14 @@ class MultiResolutionSTFTLoss(torch.nn.Module):
     def forward(self, x, y):
         """Calculate forward propagation.
         Args:
-            x (Tensor): Predicted signal (B, T).
-            y (Tensor): Groundtruth signal (B, T).
+            x (Tensor): Predicted signal (B, T) or (B, C, T).
+            y (Tensor): Groundtruth signal (B, T) or (B, C, T).
         Returns:
             Tensor: Multi resolution spectral convergence loss value.
             Tensor: Multi resolution log STFT magnitude loss value.
         """
-        sc_loss = 0.0
-        mag_loss = 0.0
-        for f in self.stft_losses:
-            sc_l, mag_l = f(x, y)
-            sc_loss += sc_l
-            mag_loss += mag_l
-        sc_loss /= len(self.stft_losses)
-        mag_loss /= len(self.stft_losses)
+        sc_losses, mag_losses = zip(*[f(x, y) for f in self.stft_losses])
+        sc_loss = torch.stack(sc_losses).mean()
+        mag_loss = torch.stack(mag_losses).mean()
 
         return self.factor_sc*sc_loss, self.factor_mag*mag_loss
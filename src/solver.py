@@ -2,11 +2,13 @@
 This code is based on Facebook's HDemucs code: https://github.com/facebookresearch/demucs
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
 from pathlib import Path
 import os
 import time
+from typing import NamedTuple, Optional
 import wandb
 
 import torch
@@ -21,8 +23,9 @@ from src.evaluate import evaluate, evaluate_on_saved_data
 from src.model_serializer import SERIALIZE_KEY_BEST_STATES, SERIALIZE_KEY_MODELS, SERIALIZE_KEY_OPTIMIZERS,  \
     SERIALIZE_KEY_STATE, SERIALIZE_KEY_HISTORY, serialize
 from src.models.discriminators import discriminator_loss, feature_loss, generator_loss
+from src.models.losses import FusedGenLoss, hinge_neg, hinge_pos
 from src.models.stft_loss import MultiResolutionSTFTLoss
-from src.utils import bold, copy_state, pull_metric, swap_state, LogProgress
+from src.utils import bold, pull_metric, swap_state, LogProgress, CUDAPrefetcher, CUDAGraphRunner
 from src.wandb_logger import create_wandb_table
 from src.models.spec import spectro
 
@@ -38,6 +41,18 @@ METRICS_KEY_LSD = 'Average lsd'
 METRICS_KEY_VISQOL = 'Average visqol'
 
 
+class GenLoss(NamedTuple):
+    """Generator losses of an adversarial loss, a loss disabled by the experiment is None."""
+    adversarial: Optional[torch.Tensor] = None
+    features: Optional[torch.Tensor] = None
+
+
+def _detach_features(fmaps):
+    # real feature maps are reused as targets of the feature loss, the graph through them is kept
+    # for the discriminator loss
+    return [[fmap.detach() for fmap in disc_fmaps] for disc_fmaps in fmaps]
+
+
 class Solver(object):
     def __init__(self, data, models, optimizers, args):
         self.tr_loader = data['tr_loader']
@@ -45,24 +60,61 @@ class Solver(object):
         self.tt_loader = data['tt_loader']
         self.args = args
 
+        # config values read on every step are cached as plain python objects, OmegaConf access is slow
         self.adversarial_mode = 'adversarial' in args.experiment and args.experiment.adversarial
+        self._losses = frozenset(args.losses)
+        # return_spec can be used to debug model and see explicit spectral output of model
+        self._return_spec = bool('return_spec' in args.experiment and args.experiment.return_spec)
+        self._only_features_loss = bool('only_features_loss' in args.experiment and args.experiment.only_features_loss)
+        self._only_adversarial_loss = bool('only_adversarial_loss' in args.experiment and
+                                           args.experiment.only_adversarial_loss)
+        if self.adversarial_mode:
+            self._features_loss_lambda = float(args.experiment.features_loss_lambda)
+            if 'msd_melgan' in args.experiment.discriminator_models:
+                melgan_args = args.experiment.melgan_discriminator
+                self._melgan_num_D = int(melgan_args.num_D)
+                # weight of every per layer feature loss, averaged over the discriminators and their layers
+                self._melgan_features_weights = (1.0 / melgan_args.num_D) * (4.0 / (melgan_args.n_layers + 1))
 
         self.models = models
-        self.dmodels = {k: distrib.wrap(model) for k, model in models.items()}
+        if args.channels_last:
+            # NHWC layout for the 2d convolutions of the discriminators (e.g. MPD), weights of other layers are
+            # left untouched. This has to happen before the DDP wrap.
+            for name, model in models.items():
+                if name != GENERATOR_KEY:
+                    model.to(memory_format=torch.channels_last)
+        # all parameters receive gradients every step, no need to search for unused ones
+        self.dmodels = {k: distrib.wrap(model, find_unused_parameters=False, static_graph=args.ddp_static_graph,
+                                        bucket_cap_mb=args.ddp_bucket_cap_mb, gradient_as_bucket_view=True)
+                        for k, model in models.items()}
         self.model = self.models['generator']
-        self.dmodel = self.dmodels['generator']
+        # training batches have a constant shape, validation ones do not and run on the eager self.model
+        self.dmodel = self._compile(self.dmodels['generator'])
+        # discriminators are called several times per step, CUDA graphs (reduce-overhead) would overwrite
+        # the outputs of one call with the next. They also run on the variable length validation signals.
+        for name in self.dmodels:
+            if name != GENERATOR_KEY:
+                self.dmodels[name] = self._compile(self.dmodels[name], mode='default', dynamic=None)
+        # validation runs with batch size 1, where kernel launches dominate
+        self.valid_model = CUDAGraphRunner(self.model) if args.cuda_graphs else self.model
 
 
         self.optimizers = optimizers
         self.optimizer = optimizers['optimizer']
         if self.adversarial_mode:
-            self.disc_optimizers = {'disc_optimizer': optimizers['disc_optimizer']}
+            self.disc_optimizer = optimizers['disc_optimizer']
 
 
         # Training config
         self.device = args.device
         self.epochs = args.epochs
 
+        # Mixed precision, gradient scaling is only needed for float16
+        self.amp = args.amp
+        self.amp_dtype = getattr(torch, args.amp_dtype)
+        self.amp_device_type = 'cuda' if 'cuda' in self.device else 'cpu'
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp and self.amp_dtype == torch.float16)
+
         # Checkpoints
         self.continue_from = args.continue_from
         self.eval_every = args.eval_every
@@ -73,31 +125,80 @@ class Solver(object):
             self.checkpoint_file = Path(args.checkpoint_file)
             self.best_file = Path(args.best_file)
             logger.debug("Checkpoint will be saved to %s", self.checkpoint_file.resolve())
+        # checkpoints are written to disk in the background, at most one at a time
+        self._save_executor = ThreadPoolExecutor(max_workers=1)
+        self._save_future = None
         self.history_file = args.history_file
 
         self.best_states = None
+        self._best_states_buffers = {}
+        self._best_states_saved = False
         self.restart = args.restart
         self.history = []  # Keep track of loss
         self.samples_dir = args.samples_dir  # Where to save samples
 
         self.num_prints = args.num_prints  # Number of times to log per epoch
 
-        if 'stft' in self.args.losses:
+        # anomaly detection adds considerable overhead to every autograd op, only use it for debugging
+        torch.autograd.set_detect_anomaly(args.debug_anomaly)
+
+        self.time_loss = None
+        if 'l1' in self._losses or 'l2' in self._losses:
+            # validation signals vary in length, let the compiler handle dynamic shapes
+            self.time_loss = self._compile(FusedGenLoss(l1='l1' in self._losses, l2='l2' in self._losses),
+                                           mode='default', dynamic=None)
+
+        if 'stft' in self._losses:
             self.mrstftloss = MultiResolutionSTFTLoss(factor_sc=args.stft_sc_factor,
                                                   factor_mag=args.stft_mag_factor).to(self.device)
 
-        if 'discriminator_model' in self.args.experiment and \
-                self.args.experiment.discriminator_model == 'hifi':
+        # the mel spectrogram (and its filterbank) is built once, and only if some loss uses it
+        needs_mel = self.adversarial_mode and 'hifi' in self.args.experiment.discriminator_models
+        if needs_mel:
             self.melspec_transform = torchaudio.transforms.MelSpectrogram(
                                             self.args.experiment.hr_sr,
                                             **self.args.experiment.mel_spectrogram).to(self.device)
+            self.melspec_transform = self._compile(self.melspec_transform, mode='default', dynamic=None)
+            self._mel_spec_loss_lambda = float(self.args.experiment.mel_spec_loss_lambda)
+
+        # (generator losses suffix, discriminator loss name, adversarial loss function) of each active discriminator,
+        # built once so that the training step does not go through the config
+        adversarial_losses = {'msd_melgan': ('melgan', 'msd_melgan', self._get_melgan_adversarial_loss),
+                              'msd_hifi': ('msd', 'msd', self._get_msd_adversarial_loss),
+                              'mpd': ('mpd', 'mpd', self._get_mpd_adversarial_loss),
+                              'hifi': ('hifi', 'hifi', self._get_hifi_adversarial_loss)}
+        self._active_discriminators = ()
+        if self.adversarial_mode:
+            # generator loss names are formatted here once, not on every step
+            self._active_discriminators = tuple(('adversarial_' + suffix, 'features_' + suffix, disc_name, get_loss)
+                                                for name, (suffix, disc_name, get_loss) in adversarial_losses.items()
+                                                if name in args.experiment.discriminator_models)
 
         self._reset()
 
+    def _compile(self, module, mode=None, dynamic=False):
+        if not self.args.compile:
+            return module
+        assert hasattr(torch, 'compile'), 'compile requires PyTorch >= 2.1'
+        return torch.compile(module, mode=mode or self.args.compile_mode, dynamic=dynamic)
+
     def _copy_models_states(self):
+        # states are copied into CPU buffers allocated once (pinned, for asynchronous copies from the GPU),
+        # which are overwritten by the next best states. A checkpoint being written might still read them.
+        self._wait_for_checkpoint()
+        pin_memory = torch.cuda.is_available()
         states = {}
         for name, model in self.models.items():
-            states[name] = copy_state(model.state_dict())
+            state = model.state_dict()
+            if name not in self._best_states_buffers:
+                self._best_states_buffers[name] = {k: torch.empty(v.shape, dtype=v.dtype, pin_memory=pin_memory)
+                                                   for k, v in state.items()}
+            buffers = self._best_states_buffers[name]
+            for k, v in state.items():
+                buffers[k].copy_(v, non_blocking=True)
+            states[name] = buffers
+        if pin_memory:
+            torch.cuda.synchronize()
         return states
 
     def _load(self, package, load_best=False):
@@ -148,7 +249,13 @@ class Solver(object):
             mb = n_params * 4 / 2 ** 20
             logger.info(f"{name}: parameters: {n_params}, size: {mb} MB")
 
-        torch.set_num_threads(1)
+        # DDP processes on GPU share the cores, otherwise keep torch's default of using all of them
+        # (e.g. for CPU runs, where STFTs and convolutions parallelize well)
+        num_threads = self.args.num_threads
+        if num_threads is None and 'cuda' in self.device and distrib.world_size > 1:
+            num_threads = max(1, os.cpu_count() // distrib.world_size)
+        if num_threads:
+            torch.set_num_threads(num_threads)
 
         best_loss = None
         self.best_states = {}
@@ -159,7 +266,13 @@ class Solver(object):
             start = time.time()
             logger.info('-' * 70)
             logger.info("Training...")
-            losses = self._run_one_epoch(epoch)
+            # validation and test files all have different lengths, benchmarking would re-run for each of them
+            cudnn_benchmark = torch.backends.cudnn.benchmark
+            torch.backends.cudnn.benchmark = self.args.cudnn_benchmark
+            try:
+                losses = self._run_one_epoch(epoch)
+            finally:
+                torch.backends.cudnn.benchmark = cudnn_benchmark
             logger_msg = f'Train Summary | End of Epoch {epoch + 1} | Time {time.time() - start:.2f}s | ' \
                          + ' | '.join([f'{k} Loss {v:.5f}' for k, v in losses.items()])
             logger.info(bold(logger_msg))
@@ -197,6 +310,7 @@ class Solver(object):
                 if evaluation_loss == best_loss:
                     logger.info(bold('New best valid loss %.4f'), evaluation_loss)
                     self.best_states = self._copy_models_states()
+                    self._best_states_saved = False
                     # a bit weird that we don't save/load optimizers' best states. Should we?
 
 
@@ -270,13 +384,25 @@ class Solver(object):
                 json.dump(self.history, open(self.history_file, "w"), indent=2)
                 # Save model each epoch
                 if self.checkpoint:
-                    serialize(self.models, self.optimizers, self.history, self.best_states, self.args)
-                    logger.debug("Checkpoint saved to %s", self.checkpoint_file.resolve())
+                    self._wait_for_checkpoint()
+                    # best models are only written when there is a new best
+                    self._save_future = serialize(self.models, self.optimizers, self.history, self.best_states,
+                                                  self.args, executor=self._save_executor,
+                                                  save_best=not self._best_states_saved)
+                    self._best_states_saved = True
+
+        self._wait_for_checkpoint()
+
+    def _wait_for_checkpoint(self):
+        # also raises any error that happened while saving
+        if self._save_future is not None:
+            self._save_future.result()
+            self._save_future = None
 
 
     def _run_one_epoch(self, epoch, cross_valid=False):
         total_losses = {}
-        total_loss = 0
+        total_loss = torch.zeros((), device=self.device)
         data_loader = self.tr_loader if not cross_valid else self.cv_loader
 
         # get a different order for distributed training, otherwise this will get ignored
@@ -284,67 +410,59 @@ class Solver(object):
 
         label = ["Train", "Valid"][cross_valid]
         name = label + f" | Epoch {epoch + 1}"
-        logprog = LogProgress(logger, data_loader, updates=self.num_prints, name=name)
+        logprog = LogProgress(logger, CUDAPrefetcher(data_loader, self.device), updates=self.num_prints, name=name)
+        # losses are accumulated on device and only synced to host when they are logged
+        log_every = max(1, len(data_loader) // self.num_prints)
 
-        # return_spec can be used to debug model and see explicit spectral output of model
-        return_spec = 'return_spec' in self.args.experiment and self.args.experiment.return_spec
+        return_spec = self._return_spec
+        generator = self.dmodel if not cross_valid else self.valid_model
 
         for i, data in enumerate(logprog):
-            lr, hr = [x.to(self.device) for x in data]
-
-            if return_spec:
-                pr_time, pr_spec = self.dmodel(lr, return_spec=return_spec)
-                if cross_valid:
-                    pr_time = match_signal(pr_time, hr.shape[-1])
-
-                hr_spec = self.dmodel._spec(hr, scale=True)
-
-                hr_reprs = {'time': hr, 'spec': hr_spec}
-                pr_reprs = {'time': pr_time, 'spec': pr_spec}
-            else:
-                pr_time = self.dmodel(lr)
-                if cross_valid:
-                    pr_time = match_signal(pr_time, hr.shape[-1])
+            lr, hr = data
+
+            with torch.autocast(device_type=self.amp_device_type, dtype=self.amp_dtype, enabled=self.amp):
+                if return_spec:
+                    pr_time, pr_spec = generator(lr, return_spec=return_spec)
+                    if cross_valid:
+                        pr_time = match_signal(pr_time, hr.shape[-1])
+
+                    # no loss reads the spectrograms, the target one is not computed on every step. The
+                    # prediction's is a by-product of the model kept for debugging
+                    hr_reprs = {'time': hr}
+                    pr_reprs = {'time': pr_time, 'spec': pr_spec}
+                else:
+                    pr_time = generator(lr)
+                    if cross_valid:
+                        pr_time = match_signal(pr_time, hr.shape[-1])
 
-                hr_reprs = {'time': hr}
-                pr_reprs = {'time': pr_time}
+                    hr_reprs = {'time': hr}
+                    pr_reprs = {'time': pr_time}
 
-            losses = self._get_losses(hr_reprs, pr_reprs)
-            total_generator_loss = 0
-            for loss_name, loss in losses['generator'].items():
-                total_generator_loss += loss
+                losses = self._get_losses(hr_reprs, pr_reprs)
+                total_generator_loss = torch.stack(list(losses['generator'].values())).sum()
 
             # optimize model in training mode
             if not cross_valid:
                 self._optimize(total_generator_loss)
                 if self.adversarial_mode:
                     self._optimize_adversarial(losses['discriminator'])
+                self.scaler.update()
 
-            total_loss += total_generator_loss.item()
-            for loss_name, loss in losses['generator'].items():
-                total_loss_name = 'generator_' + loss_name
-                if total_loss_name in total_losses:
-                    total_losses[total_loss_name] += loss.item()
-                else:
-                    total_losses[total_loss_name] = loss.item()
-
-            for loss_name, loss in losses['discriminator'].items():
-                total_loss_name = 'discriminator_' + loss_name
-                if total_loss_name in total_losses:
-                    total_losses[total_loss_name] += loss.item()
-                else:
-                    total_losses[total_loss_name] = loss.item()
+            total_loss += total_generator_loss.detach().float()
+            self._accumulate_losses(total_losses, losses)
 
-            logprog.update(total_loss=format(total_loss / (i + 1), ".5f"))
+            if (i + 1) % log_every == 0:
+                logprog.update(total_loss=format(total_loss.item() / (i + 1), ".5f"))
             # Just in case, clear some memory
             if return_spec:
-                del pr_spec, hr_spec
+                del pr_spec
             del pr_reprs, hr_reprs, pr_time, hr, lr
 
+        total_loss = total_loss.item()
         avg_losses = {'total': total_loss / (i + 1)}
         avg_losses.update({'evaluation': total_loss / (i + 1)})
         for loss_name, loss in total_losses.items():
-            avg_losses.update({loss_name: loss / (i + 1)})
+            avg_losses.update({loss_name: loss.item() / (i + 1)})
 
         return avg_losses
 
@@ -352,132 +470,113 @@ class Solver(object):
     # enhanced files for later use. Kind of ugly...
     def _get_valid_losses_on_test_data(self, epoch, enhance):
         total_losses = {}
-        total_loss = 0
+        total_loss = torch.zeros((), device=self.device)
         data_loader = self.tt_loader
 
         # get a different order for distributed training, otherwise this will get ignored
         data_loader.epoch = epoch
 
         name = f"Valid | Epoch {epoch + 1}"
-        logprog = LogProgress(logger, data_loader, updates=self.num_prints, name=name)
+        logprog = LogProgress(logger, CUDAPrefetcher(data_loader, self.device), updates=self.num_prints, name=name)
+        log_every = max(1, len(data_loader) // self.num_prints)
 
         total_filenames = []
+        is_aero = self.args.experiment.model == 'aero'
+        nfft = self.args.experiment.nfft
+        lr_sr, hr_sr = self.args.experiment.lr_sr, self.args.experiment.hr_sr
 
         for i, data in enumerate(logprog):
             (lr, lr_path), (hr, hr_path) = data
-            lr = lr.to(self.device)
-            hr = hr.to(self.device)
 
             filename = Path(hr_path[0]).stem
-            total_filenames += filename
-            if self.args.experiment.model == 'aero':
-                hr_spec = self.model._spec(hr, scale=True).detach()
-                pr_time, pr_spec, lr_spec = self.dmodel(lr, return_spec=True, return_lr_spec=True)
-                pr_spec = pr_spec.detach()
-                lr_spec = lr_spec.detach()
+            total_filenames.append(filename)
+            # spectrograms are only used for the saved samples, skip their STFTs otherwise.
+            # this runs under torch.no_grad, spectrograms need not be detached
+            if enhance and is_aero:
+                hr_spec = self.model._spec(hr, scale=True)
+                pr_time, pr_spec, lr_spec = self.model(lr, return_spec=True, return_lr_spec=True)
             else:
-                nfft = self.args.experiment.nfft
-                win_length = nfft // 4
-                pr_time = self.model(lr)
-                pr_spec = spectro(pr_time, n_fft=nfft, win_length=win_length)
-                lr_spec = spectro(lr, n_fft=nfft, win_length=win_length)
-                hr_spec = spectro(hr, n_fft=nfft, win_length=win_length)
+                pr_time = self.valid_model(lr)
+                if enhance:
+                    win_length = nfft // 4
+                    pr_spec = spectro(pr_time, n_fft=nfft, win_length=win_length)
+                    lr_spec = spectro(lr, n_fft=nfft, win_length=win_length)
+                    hr_spec = spectro(hr, n_fft=nfft, win_length=win_length)
 
             pr_time = match_signal(pr_time, hr.shape[-1])
 
             if enhance:
-                save_wavs(pr_time, lr, hr, [os.path.join(self.args.samples_dir, filename)], self.args.experiment.lr_sr,
-                          self.args.experiment.hr_sr)
+                save_wavs(pr_time, lr, hr, [os.path.join(self.args.samples_dir, filename)], lr_sr, hr_sr)
                 save_specs(lr_spec, pr_spec, hr_spec, os.path.join(self.args.samples_dir, filename))
 
-            hr_reprs = {'time': hr, 'spec': hr_spec}
-            pr_reprs = {'time': pr_time, 'spec': pr_spec}
+            hr_reprs = {'time': hr}
+            pr_reprs = {'time': pr_time}
 
             losses = self._get_losses(hr_reprs, pr_reprs)
-            total_generator_loss = 0
-            for loss_name, loss in losses['generator'].items():
-                total_generator_loss += loss
-
-            total_loss += total_generator_loss.item()
-            for loss_name, loss in losses['generator'].items():
-                total_loss_name = 'generator_' + loss_name
-                if total_loss_name in total_losses:
-                    total_losses[total_loss_name] += loss.item()
-                else:
-                    total_losses[total_loss_name] = loss.item()
+            total_generator_loss = torch.stack(list(losses['generator'].values())).sum()
 
-            for loss_name, loss in losses['discriminator'].items():
-                total_loss_name = 'discriminator_' + loss_name
-                if total_loss_name in total_losses:
-                    total_losses[total_loss_name] += loss.item()
-                else:
-                    total_losses[total_loss_name] = loss.item()
+            total_loss += total_generator_loss.detach().float()
+            self._accumulate_losses(total_losses, losses)
 
-            logprog.update(total_loss=format(total_loss / (i + 1), ".5f"))
+            if (i + 1) % log_every == 0:
+                logprog.update(total_loss=format(total_loss.item() / (i + 1), ".5f"))
             # Just in case, clear some memory
             del pr_reprs, hr_reprs
 
+        total_loss = total_loss.item()
         avg_losses = {'total': total_loss / (i + 1)}
         avg_losses.update({'evaluation': total_loss / (i + 1)})
         for loss_name, loss in total_losses.items():
-            avg_losses.update({loss_name: loss / (i + 1)})
+            avg_losses.update({loss_name: loss.item() / (i + 1)})
 
         return avg_losses, total_filenames if enhance else None
 
 
+    def _accumulate_losses(self, total_losses, losses):
+        for loss_type in ['generator', 'discriminator']:
+            for loss_name, loss in losses[loss_type].items():
+                total_loss_name = loss_type + '_' + loss_name
+                if total_loss_name in total_losses:
+                    total_losses[total_loss_name] = total_losses[total_loss_name] + loss.detach().float()
+                else:
+                    total_losses[total_loss_name] = loss.detach().float()
+
     def _get_losses(self, hr, pr):
         hr_time = hr['time']
         pr_time = pr['time']
 
         losses = {'generator': {}, 'discriminator': {}}
-        with torch.autograd.set_detect_anomaly(True):
-            if 'l1' in self.args.losses:
-                losses['generator'].update({'l1': F.l1_loss(pr_time, hr_time)})
-            if 'l2' in self.args.losses:
-                losses['generator'].update({'l2': F.mse_loss(pr_time, hr_time)})
-            if 'stft' in self.args.losses:
-                stft_loss = self._get_stft_loss(pr_time, hr_time)
-                losses['generator'].update({'stft': stft_loss})
-
-            if self.adversarial_mode:
-                if 'msd_melgan' in self.args.experiment.discriminator_models:
-                    generator_losses, discriminator_loss = self._get_melgan_adversarial_loss(pr_time, hr_time)
-                    if not self.args.experiment.only_features_loss:
-                        losses['generator'].update({'adversarial_melgan': generator_losses['adversarial']})
-                    if not self.args.experiment.only_adversarial_loss:
-                        losses['generator'].update({'features_melgan': generator_losses['features']})
-                    losses['discriminator'].update({'msd_melgan': discriminator_loss})
-                if 'msd_hifi' in self.args.experiment.discriminator_models:
-                    generator_losses, discriminator_loss = self._get_msd_adversarial_loss(pr_time, hr_time)
-                    if not self.args.experiment.only_features_loss:
-                        losses['generator'].update({'adversarial_msd': generator_losses['adversarial']})
-                    if not self.args.experiment.only_adversarial_loss:
-                        losses['generator'].update({'features_msd': generator_losses['features']})
-                    losses['discriminator'].update({'msd': discriminator_loss})
-                if 'mpd' in self.args.experiment.discriminator_models:
-                    generator_losses, discriminator_loss = self._get_mpd_adversarial_loss(pr_time, hr_time)
-                    if not self.args.experiment.only_features_loss:
-                        losses['generator'].update({'adversarial_mpd': generator_losses['adversarial']})
-                    if not self.args.experiment.only_adversarial_loss:
-                        losses['generator'].update({'features_mpd': generator_losses['features']})
-                    losses['discriminator'].update({'mpd': discriminator_loss})
-                if 'hifi' in self.args.experiment.discriminator_models:
-                    generator_loss, discriminator_loss = self._get_hifi_adversarial_loss(pr_time, hr_time)
-                    losses['generator'].update({'adversarial_hifi': generator_loss})
-                    losses['discriminator'].update({'hifi': discriminator_loss})
+        if self.time_loss is not None:
+            losses['generator'].update(self.time_loss(pr_time, hr_time))
+        if 'stft' in self._losses:
+            stft_loss = self._get_stft_loss(pr_time, hr_time)
+            losses['generator'].update({'stft': stft_loss})
+
+        for adversarial_name, features_name, discriminator_name, get_adversarial_loss in self._active_discriminators:
+            generator_losses, discriminator_loss = get_adversarial_loss(pr_time, hr_time)
+            if generator_losses.adversarial is not None:
+                losses['generator'][adversarial_name] = generator_losses.adversarial
+            if generator_losses.features is not None:
+                losses['generator'][features_name] = generator_losses.features
+            losses['discriminator'][discriminator_name] = discriminator_loss
         return losses
 
     def _get_stft_loss(self, pr, hr):
-        sc_loss, mag_loss = self.mrstftloss(pr.squeeze(1), hr.squeeze(1))
-        stft_loss = sc_loss + mag_loss
-        return stft_loss
+        # torch.stft is numerically sensitive (and unsupported in bfloat16), keep it in full precision
+        with torch.autocast(device_type=self.amp_device_type, enabled=False):
+            sc_loss, mag_loss = self.mrstftloss(pr.float(), hr.float())
+            return sc_loss + mag_loss
 
     def _get_melgan_adversarial_loss(self, pr, hr):
 
         discriminator = self.dmodels['msd_melgan']
 
-        discriminator_fake_detached = discriminator(pr.detach())
-        discriminator_real = discriminator(hr)
+        # real and detached fake signals go through the discriminator as a single batch,
+        # the discriminator has no batch dependent layers
+        batch_size = hr.shape[0]
+        discriminator_both = discriminator(torch.cat([hr, pr.detach()]))
+        discriminator_real = [[t[:batch_size] for t in scale] for scale in discriminator_both]
+        discriminator_fake_detached = [[t[batch_size:] for t in scale] for scale in discriminator_both]
         discriminator_fake = discriminator(pr)
 
         total_loss_discriminator = self._get_melgan_discriminator_loss(discriminator_fake_detached, discriminator_real)
@@ -488,36 +587,28 @@ class Solver(object):
 
 
     def _get_melgan_discriminator_loss(self, discriminator_fake, discriminator_real):
-        discriminator_loss = 0
-        for scale in discriminator_fake:
-            discriminator_loss += F.relu(1 + scale[-1]).mean()
-
-        for scale in discriminator_real:
-            discriminator_loss += F.relu(1 - scale[-1]).mean()
-        return discriminator_loss
+        fake_losses = torch.stack([hinge_neg(scale[-1]) for scale in discriminator_fake])
+        real_losses = torch.stack([hinge_pos(scale[-1]) for scale in discriminator_real])
+        return fake_losses.sum() + real_losses.sum()
 
     def _get_melgan_generator_loss(self, discriminator_fake, discriminator_real):
-        features_loss = 0
-        features_weights = 4.0 / (self.args.experiment.melgan_discriminator.n_layers + 1)
-        discriminator_weights = 1.0 / self.args.experiment.melgan_discriminator.num_D
-        weights = discriminator_weights * features_weights
+        features_losses = [F.l1_loss(discriminator_fake[i][j], discriminator_real[i][j].detach())
+                           for i in range(self._melgan_num_D)
+                           for j in range(len(discriminator_fake[i]) - 1)]
+        features_loss = self._melgan_features_weights * torch.stack(features_losses).sum()
 
-        for i in range(self.args.experiment.melgan_discriminator.num_D):
-            for j in range(len(discriminator_fake[i]) - 1):
-                features_loss += weights * F.l1_loss(discriminator_fake[i][j], discriminator_real[i][j].detach())
+        adversarial_loss = torch.stack([hinge_pos(scale[-1]) for scale in discriminator_fake]).sum()
 
-        adversarial_loss = 0
-        for scale in discriminator_fake:
-            adversarial_loss += F.relu(1 - scale[-1]).mean()
+        return self._get_generator_losses(adversarial_loss, features_loss)
 
-        if 'only_adversarial_loss' in self.args.experiment and self.args.experiment.only_adversarial_loss:
-            return {'adversarial': adversarial_loss}
+    def _get_generator_losses(self, adversarial_loss, features_loss):
+        if self._only_adversarial_loss:
+            return GenLoss(adversarial=adversarial_loss)
 
-        if 'only_features_loss' in self.args.experiment and self.args.experiment.only_features_loss:
-            return {'features': self.args.experiment.features_loss_lambda * features_loss}
+        if self._only_features_loss:
+            return GenLoss(features=self._features_loss_lambda * features_loss)
 
-        return {'adversarial': adversarial_loss,
-                'features': self.args.experiment.features_loss_lambda * features_loss}
+        return GenLoss(adversarial_loss, self._features_loss_lambda * features_loss)
 
 
     def _get_hifi_adversarial_loss(self, pr, hr):
@@ -525,88 +616,67 @@ class Solver(object):
         msd = self.dmodels['msd_hifi']
 
         # MPD
-        y_df_hat_r, y_df_hat_g, _, _ = mpd(hr, pr.detach())
+        y_df_hat_r, y_df_hat_g, fmap_f_r, _ = mpd(hr, pr.detach())
         loss_disc_f = discriminator_loss(y_df_hat_r, y_df_hat_g)
 
         # MSD
-        y_ds_hat_r, y_ds_hat_g, _, _ = msd(hr, pr.detach())
+        y_ds_hat_r, y_ds_hat_g, fmap_s_r, _ = msd(hr, pr.detach())
         loss_disc_s = discriminator_loss(y_ds_hat_r, y_ds_hat_g)
 
         total_loss_discriminator = loss_disc_s + loss_disc_f
 
-        # L1 Mel-Spectrogram Loss
-        pr_mel = self.melspec_transform(pr)
-        hr_mel = self.melspec_transform(hr)
-        loss_mel = F.l1_loss(hr_mel, pr_mel) * self.args.experiment.mel_spec_loss_lambda
-
-        y_df_hat_r, y_df_hat_g, fmap_f_r, fmap_f_g = mpd(hr, pr)
-        y_ds_hat_r, y_ds_hat_g, fmap_s_r, fmap_s_g = msd(hr, pr)
-        loss_fm_f = feature_loss(fmap_f_r, fmap_f_g)
-        loss_fm_s = feature_loss(fmap_s_r, fmap_s_g)
+        # L1 Mel-Spectrogram Loss, the target needs no graph. Batching it with the prediction would save a
+        # transform call but double the work of the transform's backward.
+        # like the STFT loss, the transform runs in full precision, its window and filterbank are buffers moved to
+        # the device once at construction
+        with torch.autocast(device_type=self.amp_device_type, enabled=False):
+            with torch.no_grad():
+                hr_mel = self.melspec_transform(hr.float())
+            pr_mel = self.melspec_transform(pr.float())
+        loss_mel = F.l1_loss(hr_mel, pr_mel) * self._mel_spec_loss_lambda
+
+        # the real signal was already scored above, only the fake one goes through the discriminators again
+        _, y_df_hat_g, _, fmap_f_g = mpd(None, pr)
+        _, y_ds_hat_g, _, fmap_s_g = msd(None, pr)
+        loss_fm_f = feature_loss(_detach_features(fmap_f_r), fmap_f_g)
+        loss_fm_s = feature_loss(_detach_features(fmap_s_r), fmap_s_g)
         loss_gen_f = generator_loss(y_df_hat_g)
         loss_gen_s = generator_loss(y_ds_hat_g)
 
-        if 'only_features_loss' in self.args.experiment and self.args.experiment.only_features_loss:
+        if self._only_features_loss:
             total_loss_generator = loss_fm_s + loss_fm_f
         else:
             total_loss_generator = loss_gen_s + loss_gen_f + loss_fm_s + loss_fm_f + loss_mel
 
-        return total_loss_generator, total_loss_discriminator
+        return GenLoss(adversarial=total_loss_generator), total_loss_discriminator
 
 
     def _get_msd_adversarial_loss(self, pr, hr):
-        msd = self.dmodels['msd_hifi']
-
-        # discriminator loss
-        y_ds_hat_r, y_ds_hat_g, _, _ = msd(hr, pr.detach())
-        d_loss = discriminator_loss(y_ds_hat_r, y_ds_hat_g)
-
-        # generator loss
-        y_ds_hat_r, y_ds_hat_g, fmap_s_r, fmap_s_g = msd(hr, pr)
-        g_feat_loss = feature_loss(fmap_s_r, fmap_s_g)
-        g_adv_loss = generator_loss(y_ds_hat_g)
-
-
-        if 'only_adversarial_loss' in self.args.experiment and self.args.experiment.only_adversarial_loss:
-            return {'adversarial': g_adv_loss}, d_loss
-
-        if 'only_features_loss' in self.args.experiment and self.args.experiment.only_features_loss:
-            return {'features': self.args.experiment.features_loss_lambda * g_feat_loss}, d_loss
-
-        return {'adversarial': g_adv_loss,
-                'features': self.args.experiment.features_loss_lambda * g_feat_loss}, d_loss
-
+        return self._get_hifi_discriminator_losses(self.dmodels['msd_hifi'], pr, hr)
 
     def _get_mpd_adversarial_loss(self, pr, hr):
-        mpd = self.dmodels['mpd']
+        return self._get_hifi_discriminator_losses(self.dmodels['mpd'], pr, hr)
 
+    def _get_hifi_discriminator_losses(self, discriminator, pr, hr):
         # discriminator loss
-        y_df_hat_r, y_df_hat_g, _, _ = mpd(hr, pr.detach())
-        d_loss = discriminator_loss(y_df_hat_r, y_df_hat_g)
-
-        # generator loss
-        y_df_hat_r, y_df_hat_g, fmap_f_r, fmap_f_g = mpd(hr, pr)
-        g_feat_loss = feature_loss(fmap_f_r, fmap_f_g)
-        g_adv_loss = generator_loss(y_df_hat_g)
-
-        if 'only_adversarial_loss' in self.args.experiment and self.args.experiment.only_adversarial_loss:
-            return {'adversarial': g_adv_loss}, d_loss
+        y_d_r, y_d_g, fmap_r, _ = discriminator(hr, pr.detach())
+        d_loss = discriminator_loss(y_d_r, y_d_g)
 
-        if 'only_features_loss' in self.args.experiment and self.args.experiment.only_features_loss:
-            return {'features': self.args.experiment.features_loss_lambda * g_feat_loss}, d_loss
+        # generator loss, the real signal was already scored above
+        _, y_d_g, _, fmap_g = discriminator(None, pr)
+        g_feat_loss = feature_loss(_detach_features(fmap_r), fmap_g)
+        g_adv_loss = generator_loss(y_d_g)
 
-        return {'adversarial': g_adv_loss,
-                'features': self.args.experiment.features_loss_lambda * g_feat_loss}, d_loss
+        return self._get_generator_losses(g_adv_loss, g_feat_loss), d_loss
 
 
     def _optimize(self, loss):
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.optimizer.zero_grad(set_to_none=True)
+        self.scaler.scale(loss).backward()
+        self.scaler.step(self.optimizer)
 
     def _optimize_adversarial(self, discriminator_losses):
-        total_disc_loss = sum(list(discriminator_losses.values()))
-        disc_optimizer = self.disc_optimizers['disc_optimizer']
-        disc_optimizer.zero_grad()
-        total_disc_loss.backward()
-        disc_optimizer.step()
\ No newline at end of file
+        self.disc_optimizer.zero_grad(set_to_none=True)
+        # one traversal of the graph for all discriminator losses
+        torch.autograd.backward([self.scaler.scale(loss) for loss in discriminator_losses.values()])
+        self.scaler.step(self.disc_optimizer)
\ No newline at end of file
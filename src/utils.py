@@ -10,6 +10,8 @@ from torch.nn import functional as F
 
 from contextlib import contextmanager
 
+logger = logging.getLogger(__name__)
+
 
 def get_network_description(network):
     '''Get the string and total parameters of the network'''
@@ -130,6 +132,128 @@ class LogProgress:
         self.logger.log(self.level, out)
 
 
+class CUDAPrefetcher:
+    """
+    Wraps a data loader and copies the next batch to the device on a side CUDA stream,
+    overlapping the host to device copy with the computation of the current step.
+    For the copy to be asynchronous, the data loader should use `pin_memory=True`.
+    Falls back to regular copies if `device` is not a CUDA device.
+    Args:
+        - loader: data loader to wrap. Batches can be nested lists/tuples of tensors,
+            items that are not tensors (e.g. file paths) are returned as is.
+        - device: device to copy the batches to.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = None
+        if 'cuda' in str(device) and torch.cuda.is_available():
+            self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self._iterator = iter(self.loader)
+        self._preload()
+        return self
+
+    def __next__(self):
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self._batch
+        if batch is None:
+            raise StopIteration
+        if self.stream is not None:
+            # the batch was allocated on the side stream, make sure its memory is not reused too early
+            _apply_to_tensors(batch, lambda t: t.record_stream(torch.cuda.current_stream()))
+        self._preload()
+        return batch
+
+    def _preload(self):
+        try:
+            batch = next(self._iterator)
+        except StopIteration:
+            self._batch = None
+            return
+        if self.stream is None:
+            self._batch = _apply_to_tensors(batch, lambda t: t.to(self.device))
+        else:
+            with torch.cuda.stream(self.stream):
+                self._batch = _apply_to_tensors(batch, lambda t: t.to(self.device, non_blocking=True))
+
+
+class CUDAGraphRunner:
+    """
+    Runs a module for inference through a CUDA graph, removing the launch overhead
+    of its many small kernels. The graph is captured for the shape of the first input
+    that is seen twice in a row, inputs of any other shape, calls under another autocast
+    state than the capture (or calls with keyword arguments) run eagerly. Outputs of a
+    replay are static buffers, overwritten by the next replay, and must be consumed before that.
+    Args:
+        - module: module to run, taking a single tensor and returning a tensor.
+        - warmup (int): number of iterations run on a side stream before capturing.
+    """
+
+    def __init__(self, module, warmup=3):
+        self.module = module
+        self.warmup = warmup
+        self._graph = None
+        self._failed = False
+        self._last_shape = None
+        self._autocast_state = None
+
+    def __call__(self, x, **kwargs):
+        if kwargs:
+            return self.module(x, **kwargs)
+        if self._graph is None and not self._failed and x.is_cuda and x.shape == self._last_shape:
+            self._capture(x)
+        self._last_shape = x.shape
+        if (self._graph is not None and x.shape == self._input.shape and
+                _get_autocast_state() == self._autocast_state):
+            self._input.copy_(x)
+            self._graph.replay()
+            return self._output
+        return self.module(x)
+
+    def _capture(self, x):
+        self._input = x.clone()
+        self._autocast_state = _get_autocast_state()
+        # under autocast, the casts of the weights have to be recorded in the graph. Casts cached by autocast
+        # are freed when the caller's autocast block exits, replays would then read released memory
+        no_cache_autocast = torch.autocast(device_type='cuda', dtype=torch.get_autocast_gpu_dtype(),
+                                           enabled=torch.is_autocast_enabled(), cache_enabled=False)
+        try:
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream), no_cache_autocast:
+                for _ in range(self.warmup):
+                    self.module(self._input)
+            torch.cuda.current_stream().wait_stream(stream)
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph), no_cache_autocast:
+                self._output = self.module(self._input)
+        except RuntimeError as e:
+            logger.warning(f'Could not capture CUDA graph, running eagerly: {e}')
+            self._failed = True
+            return
+        self._graph = graph
+
+
+def _get_autocast_state():
+    # the graph replays the precision of the kernels it was captured with
+    return torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype()
+
+
+def _apply_to_tensors(data, fn):
+    if isinstance(data, torch.Tensor):
+        return fn(data)
+    if isinstance(data, (list, tuple)):
+        return type(data)(_apply_to_tensors(x, fn) for x in data)
+    return data
+
+
 def scale_minmax(X, min=0.0, max=1.0):
     isnan = np.isnan(X).any()
     isinf = np.isinf(X).any()
@@ -173,7 +297,8 @@ def bold(text):
 
 
 def copy_state(state):
-    return {k: v.cpu().clone() for k, v in state.items()}
+    # a single copy, `v.cpu().clone()` copies GPU tensors twice
+    return {k: v.detach().to('cpu', copy=True) for k, v in state.items()}
 
 
 def serialize_model(model):
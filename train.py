@@ -1,6 +1,7 @@
 """
 This code is based on Facebook's HDemucs code: https://github.com/facebookresearch/demucs
 """
+import inspect
 import itertools
 import logging
 import os
@@ -51,10 +52,17 @@ def run(args):
     args.experiment.batch_size //= distrib.world_size
 
     # Building datasets and loaders
+    # pinned memory allows for asynchronous host to device copies,
+    # persistent workers are not re-created at the beginning of every epoch
+    loader_kwargs = {'num_workers': args.num_workers,
+                     'pin_memory': torch.cuda.is_available() and args.device == 'cuda'}
+    if args.num_workers > 0:
+        loader_kwargs.update({'persistent_workers': args.persistent_workers,
+                              'prefetch_factor': args.prefetch_factor})
     tr_dataset = LrHrSet(args.dset.train, args.experiment.lr_sr, args.experiment.hr_sr,
                          args.experiment.stride, args.experiment.segment, upsample=args.experiment.upsample)
     tr_loader = distrib.loader(tr_dataset, batch_size=args.experiment.batch_size, shuffle=True,
-                               num_workers=args.num_workers)
+                               **loader_kwargs)
 
     if args.dset.valid:
         args.valid_equals_test = args.dset.valid == args.dset.test
@@ -62,14 +70,14 @@ def run(args):
     if args.dset.valid:
         cv_dataset = LrHrSet(args.dset.valid, args.experiment.lr_sr, args.experiment.hr_sr,
                             stride=None, segment=None, upsample=args.experiment.upsample)
-        cv_loader = distrib.loader(cv_dataset, batch_size=1, shuffle=False, num_workers=args.num_workers)
+        cv_loader = distrib.loader(cv_dataset, batch_size=1, shuffle=False, **loader_kwargs)
     else:
         cv_loader = None
 
     if args.dset.test:
         tt_dataset = LrHrSet(args.dset.test, args.experiment.lr_sr, args.experiment.hr_sr,
                              stride=None, segment=None, with_path=True, upsample=args.experiment.upsample)
-        tt_loader = distrib.loader(tt_dataset, batch_size=1, shuffle=False, num_workers=args.num_workers)
+        tt_loader = distrib.loader(tt_dataset, batch_size=1, shuffle=False, **loader_kwargs)
     else:
         tt_loader = None
     data = {"tr_loader": tr_loader, "cv_loader": cv_loader, "tt_loader": tt_loader}
@@ -79,8 +87,14 @@ def run(args):
             model.cuda()
 
     # optimizer
+    # single kernel (fused) optimizer steps on CUDA where PyTorch supports them (>= 1.13),
+    # multi-tensor (foreach) ones otherwise
+    use_fused = (torch.cuda.is_available() and args.device == 'cuda' and
+                 'fused' in inspect.signature(torch.optim.Adam).parameters)
+    optim_kwargs = {'fused': True} if use_fused else {'foreach': True}
     if args.optim == "adam":
-        optimizer = torch.optim.Adam(models['generator'].parameters(), lr=args.lr, betas=(0.9, args.beta2))
+        optimizer = torch.optim.Adam(models['generator'].parameters(), lr=args.lr, betas=(0.9, args.beta2),
+                                     **optim_kwargs)
     else:
         logger.fatal('Invalid optimizer %s', args.optim)
         os._exit(1)
@@ -92,7 +106,7 @@ def run(args):
         disc_optimizer = torch.optim.Adam(
             itertools.chain(*[models[disc_name].parameters() for disc_name in
                               args.experiment.discriminator_models]),
-            args.lr, betas=(0.9, args.beta2))
+            args.lr, betas=(0.9, args.beta2), **optim_kwargs)
         optimizers.update({'disc_optimizer': disc_optimizer})
 
 